@@ -21,21 +21,24 @@ import argparse
 import httplib2
 import logging
 import os
+import shlex
 import sys
-import tempfile
+import threading
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor
-from functools import partial
-from itertools import groupby, chain
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache, partial
+from itertools import groupby, islice
 
+import google.auth
 import googleapiclient.discovery
 from google.auth import compute_engine
 import google_auth_httplib2
-from googleapiclient.http import set_user_agent
+from googleapiclient.http import HttpRequest, set_user_agent
 
 import util
 
 PLACEMENT_MAX_CNT = 22
+MAX_WORKERS = 64
 
 cfg = util.Config.load_config(Path(__file__).with_name('config.yaml'))
 
@@ -46,15 +49,75 @@ SCRIPTS_DIR = Path(__file__).parent.resolve()
 TOT_REQ_CNT = 1000
 
 instances = {}
+thread_local = threading.local()
+compute_lock = threading.Lock()
+credentials_lock = threading.Lock()
 
 if cfg.google_app_cred_path:
     os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = cfg.google_app_cred_path
 
 
-def create_instance(compute, instance_def, node_list, placement_group_name):
+@lru_cache(maxsize=None)
+def load_credentials():
+    """ load and refresh credentials, so the token is fetched once """
+    if cfg.google_app_cred_path:
+        creds, _ = google.auth.default(
+            scopes=['https://www.googleapis.com/auth/cloud-platform'])
+    else:
+        creds = compute_engine.Credentials()
+    creds.refresh(google_auth_httplib2.Request(httplib2.Http()))
+    return creds
+# [END load_credentials]
+
+
+def get_credentials():
+    """ get the credentials shared by all threads """
+    # threads start together, only let the first one fetch the token
+    with credentials_lock:
+        return load_credentials()
+# [END get_credentials]
+
+
+def get_http():
+    """ get the authorized http of the current thread, building it once.
+    httplib2 is not thread-safe, so each thread needs its own. It keeps its
+    connection alive for every request made by that thread.
+    """
+    if not hasattr(thread_local, 'http'):
+        http = set_user_agent(httplib2.Http(),
+                              "Slurm_GCP_Scripts/1.2 (GPN:SchedMD)")
+        thread_local.http = google_auth_httplib2.AuthorizedHttp(
+            get_credentials(), http=http)
+    return thread_local.http
+# [END get_http]
+
+
+def build_request(http, *args, **kwargs):
+    """ requestBuilder sending each request on the calling thread's http """
+    return HttpRequest(get_http(), *args, **kwargs)
+# [END build_request]
+
+
+@lru_cache(maxsize=None)
+def build_compute():
+    """ build the compute client shared by all threads """
+    return googleapiclient.discovery.build('compute', 'v1',
+                                           http=get_http(),
+                                           requestBuilder=build_request,
+                                           cache_discovery=False)
+# [END build_compute]
 
-    # Configure the machine
 
+def get_compute():
+    """ get the shared compute client, the discovery doc is parsed once """
+    with compute_lock:
+        return build_compute()
+# [END get_compute]
+
+
+@lru_cache(maxsize=None)
+def get_metadata_files():
+    """ read the scripts passed to instances in metadata, only once """
     meta_files = {
         'config': SCRIPTS_DIR/'config.yaml',
         'util-script': SCRIPTS_DIR/'util.py',
@@ -63,20 +126,39 @@ def create_instance(compute, instance_def, node_list, placement_group_name):
     }
     custom_compute = SCRIPTS_DIR/'custom-compute-install'
     if custom_compute.exists():
-        meta_files['custom-compute-install'] = str(custom_compute)
+        meta_files['custom-compute-install'] = custom_compute
+
+    return tuple({'key': k, 'value': v.read_text()}
+                 for k, v in meta_files.items())
+# [END get_metadata_files]
+
+
+@lru_cache(maxsize=None)
+def get_subnetwork(pid):
+    """ subnetwork link for instance_def pid """
+    instance_def = cfg.instance_defs[pid]
+    return "projects/{}/regions/{}/subnetworks/{}".format(
+        cfg.shared_vpc_host_project or cfg.project,
+        instance_def.region,
+        (instance_def.vpc_subnet
+         or f'{cfg.cluster_name}-{instance_def.region}'))
+# [END get_subnetwork]
+
+
+@lru_cache(maxsize=None)
+def instance_config(pid, placement_group_name):
+    """ instanceProperties for instance_def pid, shared by all of its chunks.
+    The returned dict is cached and must not be modified.
+    """
+    instance_def = cfg.instance_defs[pid]
 
+    # Configure the machine
     config = {
         'name': 'notused',
 
         # Specify a network interface
         'networkInterfaces': [{
-            'subnetwork': (
-                "projects/{}/regions/{}/subnetworks/{}".format(
-                    cfg.shared_vpc_host_project or cfg.project,
-                    instance_def.region,
-                    (instance_def.vpc_subnet
-                     or f'{cfg.cluster_name}-{instance_def.region}'))
-            ),
+            'subnetwork': get_subnetwork(pid),
         }],
 
         'tags': {'items': ['compute']},
@@ -87,7 +169,7 @@ def create_instance(compute, instance_def, node_list, placement_group_name):
                  'value': 'TRUE'},
                 {'key': 'VmDnsSetting',
                  'value': 'GlobalOnly'},
-                *[{'key': k, 'value': Path(v).read_text()} for k, v in meta_files.items()]
+                *get_metadata_files(),
             ]
         }
     }
@@ -147,7 +229,17 @@ def create_instance(compute, instance_def, node_list, placement_group_name):
             {'type': 'ONE_TO_ONE_NAT', 'name': 'External NAT'}
         ]
 
-    perInstanceProperties = {k: {} for k in node_list}
+    return config
+# [END instance_config]
+
+
+def create_instance(compute, pid, node_list, placement_group_name):
+
+    instance_def = cfg.instance_defs[pid]
+    config = instance_config(pid, placement_group_name)
+
+    # the body is only serialized, so all nodes can share one empty dict
+    perInstanceProperties = dict.fromkeys(node_list, {})
     body = {
         'count': len(node_list),
         'instanceProperties': config,
@@ -179,34 +271,27 @@ def create_instance(compute, instance_def, node_list, placement_group_name):
 
 
 def add_instances(node_chunk):
+    """ create the instances in node_chunk, return failed nodes by reason """
 
+    pid = node_chunk['pid']
     node_list = node_chunk['nodes']
     pg_name = None
     if 'pg' in node_chunk:
         pg_name = node_chunk['pg']
     log.debug(f"node_list:{node_list} pg:{pg_name}")
 
-    auth_http = None
-    if not cfg.google_app_cred_path:
-        http = set_user_agent(httplib2.Http(),
-                              "Slurm_GCP_Scripts/1.2 (GPN:SchedMD)")
-        creds = compute_engine.Credentials()
-        auth_http = google_auth_httplib2.AuthorizedHttp(creds, http=http)
-    compute = googleapiclient.discovery.build('compute', 'v1',
-                                              http=auth_http,
-                                              cache_discovery=False)
-    pid = util.get_pid(node_list[0])
+    compute = get_compute()
     instance_def = cfg.instance_defs[pid]
 
     try:
-        operation = create_instance(compute, instance_def, node_list, pg_name)
+        operation = create_instance(compute, pid, node_list, pg_name)
     except googleapiclient.errors.HttpError as e:
         log.error(f"failed to add {node_list[0]}*{len(node_list)} to slurm, {e}")
         if instance_def.exclusive:
             os._exit(1)
-        down_nodes(node_list, e)
-        return
+        return {str(e): node_list}
 
+    failed_nodes = {}
     result = util.wait_for_operation(compute, cfg.project, operation)
     if not result or 'error' in result:
         grp_err_msg = result['error']['errors'][0]['message']
@@ -215,7 +300,6 @@ def add_instances(node_chunk):
             os._exit(1)
 
         group_ops = util.get_group_operations(compute, cfg.project, result)
-        failed_nodes = {}
         for op in group_ops['items']:
             if op['operationType'] != 'insert':
                 continue
@@ -228,21 +312,16 @@ def add_instances(node_chunk):
                     failed_nodes[err_msg].append(failed_node)
         if failed_nodes:
             log.error(f"insert requests failed: {failed_nodes}")
-            for msg, nodes in failed_nodes.items():
-                down_nodes(nodes, msg)
 
+    return failed_nodes
 # [END add_instances]
 
 
 def down_nodes(node_list, reason):
     """ set nodes in node_list down with given reason """
-    with tempfile.NamedTemporaryFile(mode='w+t') as f:
-        f.writelines("\n".join(node_list))
-        f.flush()
-        hostlist = util.run(f"{SCONTROL} show hostlist {f.name}",
-                            check=True, get_stdout=True).stdout.rstrip()
-    util.run(
-        f"{SCONTROL} update nodename={hostlist} state=down reason='{reason}'")
+    hostlist = util.to_hostlist(node_list)
+    util.run(f"{SCONTROL} update nodename={hostlist} state=down "
+             f"reason={shlex.quote(reason)}")
 # [END down_nodes]
 
 
@@ -253,56 +332,77 @@ def hold_job(job_id, reason):
 # [END hold_job]
 
 
+def create_placement_group(compute, pg_name, vm_count, region):
+    """ insert placement group and wait for it to be created """
+    config = {
+        'name': pg_name,
+        'region': region,
+        'groupPlacementPolicy': {
+            "collocation": "COLLOCATED",
+            "vmCount": vm_count,
+         }
+    }
+    operation = util.ensure_execute(
+        compute.resourcePolicies().insert(
+            project=cfg.project, region=region, body=config))
+    return util.wait_for_operation(compute, cfg.project, operation)
+# [END create_placement_group]
+
+
 def create_placement_groups(arg_job_id, vm_count, region):
     log.debug(f"Creating PG: {arg_job_id} vm_count:{vm_count} region:{region}")
 
     pg_names = []
-    pg_ops = []
+    pg_counts = []
     pg_index = 0
 
-    auth_http = None
-    if not cfg.google_app_cred_path:
-        http = set_user_agent(httplib2.Http(),
-                              "Slurm_GCP_Scripts/1.2 (GPN:SchedMD)")
-        creds = compute_engine.Credentials()
-        auth_http = google_auth_httplib2.AuthorizedHttp(creds, http=http)
-    compute = googleapiclient.discovery.build('compute', 'v1',
-                                              http=auth_http,
-                                              cache_discovery=False)
-
-    for i in range(vm_count):
-        if i % PLACEMENT_MAX_CNT:
-            continue
+    for i in range(0, vm_count, PLACEMENT_MAX_CNT):
         pg_index += 1
-        pg_name = f'{cfg.cluster_name}-{arg_job_id}-{pg_index}'
-        pg_names.append(pg_name)
-
-        config = {
-            'name': pg_name,
-            'region': region,
-            'groupPlacementPolicy': {
-                "collocation": "COLLOCATED",
-                "vmCount": min(vm_count - i, PLACEMENT_MAX_CNT)
-             }
-        }
-
-        pg_ops.append(util.ensure_execute(
-            compute.resourcePolicies().insert(
-                project=cfg.project, region=region, body=config)))
-
-    for operation in pg_ops:
-        result = util.wait_for_operation(compute, cfg.project, operation)
-        if result and 'error' in result:
-            err_msg = result['error']['errors'][0]['message']
-            log.error(f" placement group operation failed: {err_msg}")
-            os._exit(1)
+        pg_names.append(f'{cfg.cluster_name}-{arg_job_id}-{pg_index}')
+        pg_counts.append(min(vm_count - i, PLACEMENT_MAX_CNT))
+
+    # insert and wait on all placement groups concurrently, sharing one
+    # client; each worker thread only gets its own http
+    compute = get_compute()
+    with ThreadPoolExecutor(
+            max_workers=min(len(pg_names), MAX_WORKERS)) as exe:
+        results = exe.map(partial(create_placement_group, compute,
+                                  region=region),
+                          pg_names, pg_counts)
+        for result in results:
+            if result and 'error' in result:
+                err_msg = result['error']['errors'][0]['message']
+                log.error(f" placement group operation failed: {err_msg}")
+                os._exit(1)
 
     return pg_names
 # [END create_placement_groups]
 
 
+def chunks(pid, lst, pg_names):
+    """ group list of nodes in pid into chunks of max size n """
+    n = 1000
+    if pg_names:
+        n = PLACEMENT_MAX_CNT
+
+    it = iter(lst)
+    for pg_index, nodes in enumerate(iter(lambda: list(islice(it, n)), [])):
+        chunk = dict(pid=pid, nodes=nodes)
+        if pg_names:
+            chunk['pg'] = pg_names[pg_index]
+        yield chunk
+# [END chunks]
+
+
 def main(arg_nodes, arg_job_id):
     log.debug(f"Bursting out: {arg_nodes} {arg_job_id}")
+    if arg_job_id:
+        # check before paying for scontrol to expand the node list
+        pid = util.get_pid(util.first_hostname(arg_nodes))
+        if not cfg.instance_defs[pid].exclusive:
+            # Don't create from calls by PrologSlurmctld
+            return
+
     # Get node list
     nodes_str = util.run(f"{SCONTROL} show hostnames {arg_nodes}",
                          check=True, get_stdout=True).stdout
@@ -310,9 +410,6 @@ def main(arg_nodes, arg_job_id):
 
     placement_groups = None
     pid = util.get_pid(node_list[0])
-    if (arg_job_id and not cfg.instance_defs[pid].exclusive):
-        # Don't create from calls by PrologSlurmctld
-        return
 
     nodes_by_pid = {k: tuple(nodes)
                     for k, nodes in groupby(node_list, util.get_pid)}
@@ -336,25 +433,38 @@ def main(arg_nodes, arg_job_id):
             placement_groups = create_placement_groups(
                 arg_job_id, len(node_list), cfg.instance_defs[pid].region)
 
-    def chunks(lst, pg_names):
-        """ group list into chunks of max size n """
-        n = 1000
-        if pg_names:
-            n = PLACEMENT_MAX_CNT
-
-        pg_index = 0
-        for i in range(0, len(lst), n):
-            chunk = dict(nodes=lst[i:i+n])
-            if pg_names:
-                chunk['pg'] = pg_names[pg_index]
-                pg_index += 1
-            yield chunk
+    node_chunks = [chunk for pid, nodes in nodes_by_pid.items()
+                   for chunk in chunks(pid, nodes, placement_groups)]
+
+    failed_nodes = {}
     # concurrently add nodes grouped by instance_def (pid), max 1000
-    with ThreadPoolExecutor() as exe:
-        node_chunks = chain.from_iterable(
-            map(partial(chunks, pg_names=placement_groups),
-                nodes_by_pid.values()))
-        exe.map(add_instances, node_chunks)
+    # workers spend their time waiting on the API, so run all chunks at once.
+    # Workers share one compute client, each thread only adds an http object.
+    with ThreadPoolExecutor(
+            max_workers=max(1, min(len(node_chunks), MAX_WORKERS))) as exe:
+        futures = {exe.submit(add_instances, chunk): chunk
+                   for chunk in node_chunks}
+        # handle chunks as they finish so failures are logged right away
+        for future in as_completed(futures):
+            chunk = futures[future]
+            try:
+                chunk_failed = future.result()
+            except Exception:
+                # bulkInsert may have been accepted and the instances booting.
+                # Leave them to ResumeTimeout and slurmsync.py.
+                chunk_nodes = chunk['nodes']
+                log.exception(
+                    f"failed to add {chunk_nodes[0]}*{len(chunk_nodes)} to slurm")
+                continue
+            for reason, nodes in chunk_failed.items():
+                failed_nodes.setdefault(reason, []).extend(nodes)
+
+    # one scontrol call per distinct reason rather than per failed chunk
+    for reason, nodes in failed_nodes.items():
+        try:
+            down_nodes(nodes, reason)
+        except Exception:
+            log.exception(f"failed to set {len(nodes)} nodes down: {reason}")
 
     log.info(f"done adding instances: {arg_nodes} {arg_job_id}")
 # [END main]
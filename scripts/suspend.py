@@ -115,9 +115,7 @@ def delete_placement_groups(compute, node_list, arg_job_id):
     pg_index = 0
     pid = util.get_pid(node_list[0])
 
-    for i in range(len(node_list)):
-        if i % PLACEMENT_MAX_CNT:
-            continue
+    for i in range(0, len(node_list), PLACEMENT_MAX_CNT):
         pg_index += 1
         pg_name = f'{cfg.cluster_name}-{arg_job_id}-{pg_index}'
         pg_ops.append(compute.resourcePolicies().delete(
@@ -16,11 +16,13 @@
 import logging
 import logging.config
 import os
+import re
 import shlex
 import subprocess
 import sys
 import socket
 import time
+from functools import lru_cache
 from itertools import chain, compress
 from pathlib import Path
 from contextlib import contextmanager
@@ -126,12 +128,65 @@ def spawn(cmd, quiet=False, shell=False, **kwargs):
     return subprocess.Popen(args, shell=shell, **kwargs)
 
 
+@lru_cache(maxsize=None)
 def get_pid(node_name):
     """Convert <prefix>-<pid>-<nid>"""
 
     return '-'.join(node_name.split('-')[:-1])
 
 
+def to_hostlist(nodenames):
+    """ Compress nodenames into a hostlist expression, like
+    'scontrol show hostlist', e.g. node-1,node-2,node-3,node-5 -> node-[1-3,5]
+    """
+    pattern = re.compile(r'^(.*?)(\d+)$')
+    plain = set()
+    numbered = {}
+    for name in nodenames:
+        match = pattern.match(name)
+        if match is None:
+            plain.add(name)
+            continue
+        prefix, num = match.groups()
+        # zero-padded numbers must keep their width
+        width = len(num) if len(num) > 1 and num.startswith('0') else 0
+        numbered.setdefault((prefix, width), set()).add(int(num))
+
+    def fmt_ranges(nums, width):
+        """ collapse sorted nums into 'a-b' ranges """
+        nums = sorted(nums)
+        ranges = []
+        start = prev = nums[0]
+        for num in chain(nums[1:], [None]):
+            if num is not None and num == prev + 1:
+                prev = num
+                continue
+            if start == prev:
+                ranges.append(str(start).zfill(width))
+            else:
+                ranges.append(
+                    f"{str(start).zfill(width)}-{str(prev).zfill(width)}")
+            start = prev = num
+        return ranges
+
+    hostlist = sorted(plain)
+    for (prefix, width), nums in sorted(numbered.items()):
+        ranges = fmt_ranges(nums, width)
+        if len(ranges) == 1 and '-' not in ranges[0]:
+            hostlist.append(f"{prefix}{ranges[0]}")
+        else:
+            hostlist.append(f"{prefix}[{','.join(ranges)}]")
+    return ','.join(hostlist)
+
+
+def first_hostname(hostlist):
+    """ Get the first hostname of a hostlist expression without expanding it,
+    e.g. node-[3-5,8],login -> node-3
+    """
+    match = re.match(r'([^,\[]*)(?:\[(\d+)[^\]]*\])?([^,\[]*)', hostlist)
+    return ''.join(filter(None, match.groups()))
+
+
 @contextmanager
 def cd(path):
     """ Change working directory for context """
@@ -335,28 +390,60 @@ def ensure_execute(operation):
         break
 
 
-def wait_for_operation(compute, project, operation):
-    print('Waiting for operation to finish...')
+def wait_for_operation(compute, project, operation, max_backoff=10):
+    """ Block until operation is DONE using the Operations wait endpoints.
+    wait returns when the operation is done or after ~2 minutes, so it is
+    simply reissued until done. Transient errors are retried with
+    exponential backoff, giving up after 5 consecutive failures.
+    """
+    log.debug(f"waiting for operation {operation['name']} to finish")
+    max_fails = 5
+    consec_fails = 0
+    sleep = 1.5
     while True:
         if 'zone' in operation:
-            operation = compute.zoneOperations().wait(
+            request = compute.zoneOperations().wait(
                 project=project,
                 zone=operation['zone'].split('/')[-1],
                 operation=operation['name'])
         elif 'region' in operation:
-            operation = compute.regionOperations().wait(
+            request = compute.regionOperations().wait(
                 project=project,
                 region=operation['region'].split('/')[-1],
                 operation=operation['name'])
         else:
-            operation = compute.globalOperations().wait(
+            request = compute.globalOperations().wait(
                 project=project,
                 operation=operation['name'])
 
-        result = ensure_execute(operation)
+        try:
+            result = ensure_execute(request)
+        except googleapiclient.errors.HttpError as e:
+            if e.resp.status < 500:
+                raise
+            result = None
+            err = e
+        else:
+            # ensure_execute returns None on socket timeout
+            err = "socket timed out"
+
+        if result is None:
+            consec_fails += 1
+            if consec_fails >= max_fails:
+                log.error(f"giving up on operation {operation['name']}: {err}")
+                raise RuntimeError(
+                    f"wait on {operation['name']} failed {consec_fails} times")
+            log.debug(f"retry:{consec_fails} sleep:{sleep} '{err}'")
+            time.sleep(sleep)
+            sleep = min(sleep*1.5, max_backoff)
+            continue
+
+        consec_fails = 0
+        sleep = 1.5
         if result['status'] == 'DONE':
-            print("done.")
+            log.debug(f"operation {result['name']} done")
             return result
+        operation = result
 
 
 def get_group_operations(compute, project, operation):